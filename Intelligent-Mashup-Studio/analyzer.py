@@ -1,8 +1,20 @@
 import os
+import json
+import hashlib
+import tempfile
 import subprocess
 import librosa
 import numpy as np
 
+# Bump whenever sample rate, feature extraction or brief layout changes, so stale cached briefs are not served.
+ANALYSIS_VERSION = 1
+
+def _beat_sync_mean(X, beats):
+    """Beat-synchronous mean with the same segmentation as librosa.util.sync(pad=True), in one reduceat call."""
+    n_frames = X.shape[1]
+    bounds = np.unique(np.concatenate([[0], np.clip(beats, 0, n_frames), [n_frames]])).astype(int)
+    return np.add.reduceat(X, bounds[:-1], axis=1) / np.diff(bounds)[None, :]
+
 class AudioAnalyzer:
     """
     Analyzes a single audio track to produce a detailed Creative Brief.
@@ -12,36 +24,114 @@ class AudioAnalyzer:
     def __init__(self, song_query: str):
         self.song_query = song_query
         self.workspace_dir = "workspace/audio_sources"
+        self.briefs_dir = "workspace/briefs"
         os.makedirs(self.workspace_dir, exist_ok=True)
+        os.makedirs(self.briefs_dir, exist_ok=True)
+
+    def _load_cached_brief(self, key: str):
+        brief_path = os.path.join(self.briefs_dir, f"{key}.json")
+        feats_path = os.path.join(self.briefs_dir, f"{key}_feats.npz")
+        if not (os.path.exists(brief_path) and os.path.exists(feats_path)):
+            return None
+        try:
+            with open(brief_path) as f:
+                brief = json.load(f)
+            if not os.path.exists(brief['song_info']['source_file']):
+                return None
+            with np.load(feats_path) as feats:
+                brief['analysis_results']['features_v2'] = {k: feats[k].tolist() for k in feats.files}
+            return brief
+        except Exception as e:
+            # An unreadable entry is a cache miss; the fresh analysis will overwrite it.
+            print(f"Ignoring unreadable cached brief {key}: {e}")
+            return None
+
+    def _atomic_write(self, path: str, write):
+        """Writes via a temp file in the same directory, then renames it into place."""
+        fd, temp_path = tempfile.mkstemp(dir=self.briefs_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _save_brief(self, key: str, brief: dict, features: dict):
+        # Features go to an .npz sidecar so the JSON stays small and arrays reload without list parsing.
+        # The sidecar lands first, so a visible .json always has its features next to it.
+        stripped = {**brief, "analysis_results": {k: v for k, v in brief['analysis_results'].items() if k != "features_v2"}}
+        self._atomic_write(os.path.join(self.briefs_dir, f"{key}_feats.npz"), lambda f: np.savez(f, **features))
+        self._atomic_write(os.path.join(self.briefs_dir, f"{key}.json"), lambda f: f.write(json.dumps(stripped).encode("utf-8")))
+
+    @staticmethod
+    def _cache_key(digest: str):
+        return f"v{ANALYSIS_VERSION}_{digest}"
+
+    @staticmethod
+    def _file_digest(path: str):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def _download_song(self):
         print(f"Downloading '{self.song_query}'...")
         output_template = os.path.join(self.workspace_dir, "%(title)s.%(ext)s")
-        command = ["yt-dlp", "--extract-audio", "--audio-format", "mp3", "--audio-quality", "0", "-o", output_template, "ytsearch1:" + self.song_query]
+        # Keep the native audio stream; librosa decodes m4a/opus directly, so an mp3 transcode is wasted work.
+        # Downloads go through a .part file so a concurrent download never sees a half-written final path.
+        command = ["yt-dlp", "-f", "bestaudio[ext=m4a]/bestaudio", "--print", "after_move:filepath", "-o", output_template, "ytsearch1:" + self.song_query]
         try:
             result = subprocess.run(command, check=True, capture_output=True, text=True, timeout=120)
-            for line in result.stdout.splitlines():
-                if "[ExtractAudio] Destination:" in line:
-                    filepath = line.split("Destination:")[1].strip()
-                    if os.path.exists(filepath): return filepath
+            for line in reversed(result.stdout.splitlines()):
+                filepath = line.strip()
+                if filepath and os.path.exists(filepath): return filepath
             raise FileNotFoundError("Could not determine downloaded file path.")
         except Exception as e:
             print(f"Error downloading song: {e}")
             return None
 
-    def full_analysis(self):
-        """Runs the full analysis pipeline and returns the complete Creative Brief."""
+    def full_analysis(self, on_audio_ready=None):
+        """
+        Runs the full analysis pipeline and returns the complete Creative Brief.
+        `on_audio_ready`, if given, is called with the audio path as soon as it is on disk.
+        """
+        # Analysis is deterministic given the audio, so reuse a stored brief for a repeat query or file.
+        query_key = self._cache_key(hashlib.sha256(self.song_query.encode("utf-8")).hexdigest())
+        cached = self._load_cached_brief(query_key)
+        if cached:
+            print(f"Using cached brief for '{self.song_query}'.")
+            if on_audio_ready: on_audio_ready(cached['song_info']['source_file'])
+            return cached
+
         audio_path = self._download_song()
         if not audio_path: return None
+        if on_audio_ready: on_audio_ready(audio_path)
+
+        audio_key = self._cache_key(self._file_digest(audio_path))
+        cached = self._load_cached_brief(audio_key)
+        if cached:
+            print(f"Using cached brief for '{self.song_query}'.")
+            self._save_brief(query_key, cached, {k: np.asarray(v) for k, v in cached['analysis_results']['features_v2'].items()})
+            return cached
 
         self.audio_path = audio_path
         self.file_name = os.path.splitext(os.path.basename(audio_path))[0]
-        self.y, self.sr = librosa.load(self.audio_path, sr=44100, duration=240)
+        # Analysis runs at librosa's native 22.05 kHz; full-rate audio is only needed by the AudioEngine render.
+        self.y, self.sr = librosa.load(self.audio_path, sr=22050, offset=0, duration=240, res_type='soxr_qq')
         self.tempo, self.beats = librosa.beat.beat_track(y=self.y, sr=self.sr)
         self.beat_times = librosa.frames_to_time(self.beats, sr=self.sr)
+        # One chroma pass shared by key, structure and beat-synchronous features.
+        self.chroma = librosa.feature.chroma_cqt(y=self.y, sr=self.sr)
 
         print(f"Starting robust analysis for {self.file_name}...")
-        
+
+        features = {
+            "beat_synchronous_chroma": self._extract_beat_synchronous_chroma(),
+            "rhythmic_representation": self._extract_rhythmic_representation(),
+            "spectral_balance": self._extract_spectral_balance()
+        }
         brief = {
             "song_info": {"title": self.file_name, "source_file": self.audio_path},
             "analysis_results": {
@@ -49,24 +139,20 @@ class AudioAnalyzer:
                 "estimated_key": self._analyze_key(),
                 "segments": self._analyze_structure(),
                 "lyrics": self._transcribe_lyrics(),
-                "features_v2": {
-                    "beat_synchronous_chroma": self._extract_beat_synchronous_chroma().tolist(),
-                    "rhythmic_representation": self._extract_rhythmic_representation().tolist(),
-                    "spectral_balance": self._extract_spectral_balance().tolist()
-                }
+                "features_v2": {k: v.tolist() for k, v in features.items()}
             }
         }
+        self._save_brief(query_key, brief, features)
+        self._save_brief(audio_key, brief, features)
         print(f"Robust analysis for {self.file_name} complete.")
         return brief
 
     def _analyze_key(self):
-        chroma = librosa.feature.chroma_stft(y=self.y, sr=self.sr)
         key_vals = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        return key_vals[np.argmax(np.sum(chroma, axis=1))]
+        return key_vals[np.argmax(np.sum(self.chroma, axis=1))]
 
     def _analyze_structure(self):
-        chroma = librosa.feature.chroma_cqt(y=self.y, sr=self.sr)
-        boundaries = librosa.segment.agglomerative(chroma, k=10)
+        boundaries = librosa.segment.agglomerative(self.chroma, k=10)
         segment_times = librosa.frames_to_time(boundaries, sr=self.sr)
         segments = {}
         for i, start_time in enumerate(segment_times):
@@ -86,29 +172,31 @@ class AudioAnalyzer:
         return "Lyrics would be transcribed here."
 
     def _extract_beat_synchronous_chroma(self):
-        chroma = librosa.feature.chroma_stft(y=self.y, sr=self.sr)
-        beat_chroma = librosa.util.sync(chroma, self.beats, aggregate=np.median)
+        beat_chroma = librosa.util.sync(self.chroma, self.beats, aggregate=np.median)
         return beat_chroma
 
     def _extract_rhythmic_representation(self):
-        onset_env = librosa.onset.onset_detect(y=self.y, sr=self.sr, aggregate=True)
-        y_h, y_p = librosa.effects.hpss(self.y)
-        kick_env = librosa.onset.onset_detect(y=y_p, sr=self.sr, fmax=150, aggregate=True)
-        snare_env = librosa.onset.onset_detect(y=y_h, sr=self.sr, fmin=200, fmax=2000, aggregate=True)
+        # Separate harmonic/percussive in the STFT domain and feed the mel envelopes straight to
+        # onset_strength, so one STFT replaces the istft/stft round-trips of effects.hpss + onset_strength(y=...).
+        D_h, D_p = librosa.decompose.hpss(librosa.stft(self.y, hop_length=512))
+        kick_mel = librosa.feature.melspectrogram(S=np.abs(D_p) ** 2, sr=self.sr, fmax=150)
+        snare_mel = librosa.feature.melspectrogram(S=np.abs(D_h) ** 2, sr=self.sr, fmin=200, fmax=2000)
+        kick_env = librosa.onset.onset_strength(S=librosa.power_to_db(kick_mel), sr=self.sr, aggregate=np.median)
+        snare_env = librosa.onset.onset_strength(S=librosa.power_to_db(snare_mel), sr=self.sr, aggregate=np.median)
         sub_beats_per_beat = 12
-        rhythmic_feature = np.zeros((2, len(self.beats) * sub_beats_per_beat))
-        times = librosa.times_like(onset_env, sr=self.sr)
-        for i in range(len(self.beats) - 1):
-            start_time = self.beat_times[i]
-            end_time = self.beat_times[i+1]
-            beat_duration = end_time - start_time
-            for j in range(sub_beats_per_beat):
-                sub_beat_time = start_time + (j / sub_beats_per_beat) * beat_duration
-                frame_idx = np.argmin(np.abs(times - sub_beat_time))
-                global_sub_beat_idx = i * sub_beats_per_beat + j
-                rhythmic_feature[0, global_sub_beat_idx] = kick_env[frame_idx]
-                rhythmic_feature[1, global_sub_beat_idx] = snare_env[frame_idx]
-        return rhythmic_feature.reshape(2, len(self.beats), sub_beats_per_beat).mean(axis=0).T
+        times = librosa.times_like(kick_env, sr=self.sr, hop_length=512)
+
+        # Sub-beat grid of shape (n_beats - 1, 12), snapped to the nearest onset frame in one pass.
+        durations = np.diff(self.beat_times)
+        offsets = np.arange(sub_beats_per_beat) / sub_beats_per_beat
+        sub_times = (self.beat_times[:-1, None] + durations[:, None] * offsets[None, :]).ravel()
+        idx = np.clip(np.searchsorted(times, sub_times), 1, len(times) - 1)
+        left_is_closer = (sub_times - times[idx - 1]) <= (times[idx] - sub_times)
+        frame_idx = np.where(left_is_closer, idx - 1, idx)
+
+        rhythmic_feature = np.zeros((2, len(self.beats), sub_beats_per_beat))
+        rhythmic_feature[:, :-1, :] = np.stack([kick_env[frame_idx], snare_env[frame_idx]]).reshape(2, -1, sub_beats_per_beat)
+        return rhythmic_feature.mean(axis=0).T
 
     def _extract_spectral_balance(self):
         S = np.abs(librosa.stft(self.y))
@@ -120,5 +208,5 @@ class AudioAnalyzer:
         mid_power = librosa.power_to_db(np.sum(S[mid_band, :], axis=0), ref=np.max)
         high_power = librosa.power_to_db(np.sum(S[high_band, :], axis=0), ref=np.max)
         spectral_bands = np.vstack([low_power, mid_power, high_power])
-        beat_spectral_balance = librosa.util.sync(spectral_bands, self.beats, aggregate=np.mean)
+        beat_spectral_balance = _beat_sync_mean(spectral_bands, self.beats)
         return beat_spectral_balance
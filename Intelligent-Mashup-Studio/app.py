@@ -1,10 +1,9 @@
 import os
 import uuid
-from threading import Thread
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 from dotenv import load_dotenv
-from tasks import create_mashup_task, revise_mashup_task
+from celery_app import create_mashup_job, revise_mashup_job, get_job
 
 # Load environment variables from a .env file if present
 load_dotenv()
@@ -12,9 +11,6 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app) # Allow cross-origin requests for our frontend
 
-# In-memory storage for job statuses. For production, use Redis or a database.
-jobs = {}
-
 # Ensure necessary directories exist
 os.makedirs("workspace", exist_ok=True)
 os.makedirs("workspace/audio_sources", exist_ok=True)
@@ -27,12 +23,9 @@ def create_mashup():
     if not data or 'songs' not in data or len(data['songs']) < 2:
         return jsonify({"error": "Invalid request. Please provide at least two songs."}), 400
 
+    # Queue the long-running task for a Celery worker; job state lives in the Redis result backend
     job_id = f"mashup_job_{uuid.uuid4()}"
-    jobs[job_id] = {"status": "pending", "progress": "queued"}
-    
-    # Run the long-running task in a background thread
-    thread = Thread(target=create_mashup_task, args=(job_id, data['songs'], jobs))
-    thread.start()
+    create_mashup_job.apply_async(args=(data['songs'],), task_id=job_id)
 
     return jsonify({
         "job_id": job_id,
@@ -42,10 +35,9 @@ def create_mashup():
 
 @app.route('/api/mashup/status/<job_id>', methods=['GET'])
 def get_status(job_id):
-    job = jobs.get(job_id)
-    if not job:
+    if not job_id.startswith("mashup_job_"):
         return jsonify({"error": "Job not found"}), 404
-    return jsonify(job)
+    return jsonify(get_job(job_id))
 
 @app.route('/api/mashup/revise', methods=['POST'])
 def revise_mashup():
@@ -54,10 +46,7 @@ def revise_mashup():
         return jsonify({"error": "Invalid revision request. Missing required fields."}), 400
 
     job_id = f"mashup_job_{uuid.uuid4()}"
-    jobs[job_id] = {"status": "pending", "progress": "queued for revision"}
-    
-    thread = Thread(target=revise_mashup_task, args=(job_id, data, jobs))
-    thread.start()
+    revise_mashup_job.apply_async(args=(data,), task_id=job_id)
 
     return jsonify({
         "job_id": job_id,
@@ -71,4 +60,5 @@ def get_audio(filename):
     return send_from_directory(directory, filename, as_attachment=True)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # Development only; in production run `gunicorn -w 4 -k gthread -b 0.0.0.0:5001 app:app`
+    app.run(host='0.0.0.0', port=5001, debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -0,0 +1,65 @@
+import os
+from threading import Lock
+from celery import Celery
+from dotenv import load_dotenv
+from tasks import create_mashup_task, revise_mashup_task
+
+load_dotenv()
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+celery = Celery("mashup_studio", broker=REDIS_URL, backend=REDIS_URL)
+celery.conf.update(task_track_started=True, result_extended=True)
+
+
+class TaskJob(dict):
+    """
+    A job record that mirrors every update into the Celery result backend,
+    so the status endpoint sees the same progress messages the in-memory dict used to hold.
+    """
+
+    def __init__(self, task, **fields):
+        super().__init__(**fields)
+        self.task = task
+        # task.request is thread-local, so capture the id for writes from tasks.py's worker threads.
+        self.task_id = task.request.id
+        self.lock = Lock()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.task.update_state(task_id=self.task_id, state="PROGRESS", meta=dict(self))
+
+
+class TaskJobs(dict):
+    """Single-entry stand-in for the old `jobs` dict passed to the functions in tasks.py."""
+
+    def __init__(self, task):
+        super().__init__({task.request.id: TaskJob(task, status="pending", progress="queued")})
+
+
+@celery.task(bind=True, name="mashup.create")
+def create_mashup_job(self, songs):
+    jobs = TaskJobs(self)
+    create_mashup_task(self.request.id, songs, jobs)
+    return dict(jobs[self.request.id])
+
+
+@celery.task(bind=True, name="mashup.revise")
+def revise_mashup_job(self, data):
+    jobs = TaskJobs(self)
+    revise_mashup_task(self.request.id, data, jobs)
+    return dict(jobs[self.request.id])
+
+
+def get_job(job_id: str):
+    """Returns the job record for a task id in the same shape the API has always served."""
+    result = celery.AsyncResult(job_id)
+    if result.state == "PENDING":
+        return {"status": "pending", "progress": "queued"}
+    if result.state == "STARTED":
+        return {"status": "processing", "progress": "started"}
+    if result.state in ("PROGRESS", "SUCCESS"):
+        return result.info
+    # FAILURE, REVOKED, RETRY and any custom state carry an exception (or nothing) rather than a job record.
+    return {"status": "failed", "error": str(result.info)}
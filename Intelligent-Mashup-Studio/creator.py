@@ -1,5 +1,62 @@
 import numpy as np
-from scipy.signal import correlate2d
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def _score(chroma1, chroma2, rhythm1, rhythm2, spec1, spec2):
+    """
+    Fused harmonic, rhythmic and spectral-balance mashability score for one segment pair.
+    Each feature pair must share a shape; _calculate_mashability checks this before calling.
+    """
+    width = chroma1.shape[1]
+
+    # Wrapping the pitch row mod 12 covers every key shift without a vstacked copy of chroma2.
+    best_corr = 0.0
+    for k in range(12):
+        corr = 0.0
+        for i in range(12):
+            row = (i + k) % 12
+            for j in range(width):
+                corr += chroma1[i, j] * chroma2[row, j]
+        if k == 0 or corr > best_corr:
+            best_corr = corr
+    norm1 = 0.0
+    norm2 = 0.0
+    for i in range(12):
+        for j in range(width):
+            norm1 += chroma1[i, j] * chroma1[i, j]
+            norm2 += chroma2[i, j] * chroma2[i, j]
+    harmonic_sim = best_corr / (np.sqrt(norm1) * np.sqrt(norm2) + 1e-9)
+
+    dot = 0.0
+    rnorm1 = 0.0
+    rnorm2 = 0.0
+    for i in range(rhythm1.shape[0]):
+        for j in range(width):
+            dot += rhythm1[i, j] * rhythm2[i, j]
+            rnorm1 += rhythm1[i, j] * rhythm1[i, j]
+            rnorm2 += rhythm2[i, j] * rhythm2[i, j]
+    rhythmic_sim = dot / (np.sqrt(rnorm1) * np.sqrt(rnorm2) + 1e-9)
+
+    bands = spec1.shape[0]
+    combined = np.zeros(bands)
+    for b in range(bands):
+        acc = 0.0
+        for j in range(width):
+            acc += spec1[b, j] + spec2[b, j]
+        combined[b] = acc / width
+    total = combined.sum() + 1e-9
+    mean = 0.0
+    for b in range(bands):
+        combined[b] /= total
+        mean += combined[b]
+    mean /= bands
+    var = 0.0
+    for b in range(bands):
+        var += (combined[b] - mean) ** 2
+    spectral_balance = 1 - np.sqrt(var / bands)
+
+    w_h, w_r, w_l = 1.0, 0.2, 0.2
+    return (w_h * harmonic_sim) + (w_r * rhythmic_sim) + (w_l * spectral_balance)
 
 class MashupCreator:
     """
@@ -12,6 +69,11 @@ class MashupCreator:
         if len(creative_briefs) < 2:
             raise ValueError("MashupCreator requires at least two creative briefs.")
         self.briefs = {b['song_info']['title']: b for b in creative_briefs}
+        # Briefs carry features as JSON lists; convert once so the pairing loop only slices views.
+        self._feat = {
+            title: {k: np.asarray(v, dtype=np.float32) for k, v in b['analysis_results']['features_v2'].items()}
+            for title, b in self.briefs.items()
+        }
         self.primary_title, self.secondary_title = self._select_roles()
 
     def _select_roles(self):
@@ -20,29 +82,29 @@ class MashupCreator:
         secondary = min(tempos, key=tempos.get)
         return primary, secondary
     
+    def _segment_features(self, title):
+        """Slices every segment's chroma/rhythm/spectral views for one song up front."""
+        feat = self._feat[title]
+        return {
+            seg_name: {
+                "chroma": feat['beat_synchronous_chroma'][:, info['start_beat']:info['end_beat']],
+                "rhythm": feat['rhythmic_representation'][:, info['start_beat']:info['end_beat']],
+                "spectral": feat['spectral_balance'][:, info['start_beat']:info['end_beat']]
+            }
+            for seg_name, info in self.briefs[title]['analysis_results']['segments'].items()
+        }
+
     def _calculate_mashability(self, seg1_features, seg2_features):
-        chroma1 = seg1_features['chroma']
-        chroma2 = seg2_features['chroma']
-        chroma2_padded = np.vstack([chroma2, chroma2])
-        corr = correlate2d(chroma2_padded, chroma1, mode='valid')
-        norm1 = np.linalg.norm(chroma1)
-        norm2 = np.linalg.norm(chroma2)
-        harmonic_sim = np.max(corr) / (norm1 * norm2 + 1e-9)
-        
-        rhythm1 = seg1_features['rhythm'].flatten()
-        rhythm2 = seg2_features['rhythm'].flatten()
-        rhythmic_sim = np.dot(rhythm1, rhythm2) / (np.linalg.norm(rhythm1) * np.linalg.norm(rhythm2) + 1e-9)
-
-        spec1 = seg1_features['spectral']
-        spec2 = seg2_features['spectral']
-        combined_spec = np.mean(spec1 + spec2, axis=1)
-        normalized_spec = combined_spec / (np.sum(combined_spec) + 1e-9)
-        spectral_balance = 1 - np.std(normalized_spec)
-
-        w_h, w_r, w_l = 1.0, 0.2, 0.2
-        mashability_score = (w_h * harmonic_sim) + (w_r * rhythmic_sim) + (w_l * spectral_balance)
-        
-        return mashability_score
+        for key in ('chroma', 'rhythm', 'spectral'):
+            if seg1_features[key].shape != seg2_features[key].shape:
+                raise ValueError(f"Mismatched '{key}' shapes {seg1_features[key].shape} and {seg2_features[key].shape}; crop segments to a shared width first.")
+        if seg1_features['chroma'].shape[1] != seg1_features['rhythm'].shape[1] or seg1_features['chroma'].shape[1] != seg1_features['spectral'].shape[1]:
+            raise ValueError("Chroma, rhythm and spectral features must cover the same number of beats.")
+        return _score(
+            seg1_features['chroma'], seg2_features['chroma'],
+            seg1_features['rhythm'], seg2_features['rhythm'],
+            seg1_features['spectral'], seg2_features['spectral']
+        )
 
     def create_mashup_recipe(self):
         print("Starting robust recipe creation...")
@@ -50,34 +112,32 @@ class MashupCreator:
         primary_brief = self.briefs[self.primary_title]
         secondary_brief = self.briefs[self.secondary_title]
 
+        p_segment_features = self._segment_features(self.primary_title)
+        s_segment_features = self._segment_features(self.secondary_title)
+
         timeline = []
         
         for seg_name, p_seg_info in primary_brief['analysis_results']['segments'].items():
             best_match = {"seg_name": None, "score": -1}
 
             p_start, p_end = p_seg_info['start_beat'], p_seg_info['end_beat']
-            p_features = {
-                "chroma": np.array(primary_brief['analysis_results']['features_v2']['beat_synchronous_chroma'])[:, p_start:p_end],
-                "rhythm": np.array(primary_brief['analysis_results']['features_v2']['rhythmic_representation'])[:, p_start:p_end],
-                "spectral": np.array(primary_brief['analysis_results']['features_v2']['spectral_balance'])[:, p_start:p_end]
-            }
+            p_features = p_segment_features[seg_name]
 
             for s_seg_name, s_seg_info in secondary_brief['analysis_results']['segments'].items():
                 s_start, s_end = s_seg_info['start_beat'], s_seg_info['end_beat']
                 
                 if abs((p_end - p_start) - (s_end - s_start)) > 8: continue
 
-                s_features = {
-                    "chroma": np.array(secondary_brief['analysis_results']['features_v2']['beat_synchronous_chroma'])[:, s_start:s_end],
-                    "rhythm": np.array(secondary_brief['analysis_results']['features_v2']['rhythmic_representation'])[:, s_start:s_end],
-                    "spectral": np.array(secondary_brief['analysis_results']['features_v2']['spectral_balance'])[:, s_start:s_end]
-                }
+                s_features = s_segment_features[s_seg_name]
                 
-                if p_features['chroma'].shape[1] == 0 or s_features['chroma'].shape[1] == 0: continue
-                if p_features['chroma'].shape[1] != s_features['chroma'].shape[1]:
-                     s_features['chroma'] = np.resize(s_features['chroma'], p_features['chroma'].shape)
-
-                score = self._calculate_mashability(p_features, s_features)
+                # Compare beat-for-beat over the shared length; np.resize would tile across pitch/time rows.
+                # Rhythm has one column fewer than the padded beat-sync features, so take the min over all of them.
+                width = min(v.shape[1] for features in (p_features, s_features) for v in features.values())
+                if width == 0: continue
+                score = self._calculate_mashability(
+                    {k: v[:, :width] for k, v in p_features.items()},
+                    {k: v[:, :width] for k, v in s_features.items()}
+                )
                 
                 if score > best_match['score']:
                     best_match['score'] = score
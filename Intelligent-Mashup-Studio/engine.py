@@ -1,10 +1,25 @@
 import os
-import tempfile
+import subprocess
+import numpy as np
 import soundfile as sf
 from pydub import AudioSegment
-from pydub.effects import normalize
 import pyrubberband as pyrb
 
+def separate_stems(source_file: str, stems_base_dir: str = "workspace/stems"):
+    """Runs Demucs two-stem separation into the layout AudioEngine._load_stem reads from."""
+    track_dir = os.path.join(stems_base_dir, "htdemucs", os.path.splitext(os.path.basename(source_file))[0])
+    if all(os.path.exists(os.path.join(track_dir, f)) for f in ("vocals.wav", "no_vocals.wav")):
+        return track_dir
+    print(f"Separating stems for '{source_file}'...")
+    command = ["demucs", "-n", "htdemucs", "--two-stems=vocals", "-o", stems_base_dir, source_file]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+        return track_dir
+    except Exception as e:
+        # The engine falls back to the full mix when a stem is missing.
+        print(f"Error separating stems: {e}")
+        return None
+
 class AudioEngine:
     """
     Renders the final audio track from a mashup recipe.
@@ -15,12 +30,39 @@ class AudioEngine:
         self.recipe = recipe
         self.stems_base_dir = "workspace/stems"
         self.output_dir = "workspace/mashups"
+        self.sample_rate = 44100
+        self.channels = 2
+        self.crossfade_ms = 100
         os.makedirs(self.output_dir, exist_ok=True)
         self.briefs = {b['song_info']['title']: b for b in self.recipe.get('briefs', [])}
         if not self.briefs:
              raise ValueError("Engine requires creative briefs embedded in the recipe.")
+        # Decoded float32 stems keyed by (song_title, stem_type); a recipe only ever touches a handful.
+        self._stem_cache: dict[tuple[str, str], np.ndarray] = {}
+        # Segment bounds and timeline ranges resolved once rather than per item and layer.
+        self._seg_ms = {
+            (title, name): (int(info['start_time'] * 1000), int(info['end_time'] * 1000))
+            for title, b in self.briefs.items()
+            for name, info in b['analysis_results']['segments'].items()
+        }
+        self._timeline_ms = [tuple(int(t) for t in item['time_ms'].split('-')) for item in self.recipe['timeline']]
 
     def _get_stem(self, song_title: str, stem_type: str = "instrumental"):
+        key = (song_title, stem_type)
+        if key not in self._stem_cache:
+            self._stem_cache[key] = self._to_array(self._load_stem(song_title, stem_type))
+        return self._stem_cache[key]
+
+    def _to_array(self, audio: AudioSegment):
+        """Decodes an AudioSegment to a (samples, channels) float32 array at the render rate."""
+        audio = audio.set_frame_rate(self.sample_rate).set_channels(self.channels)
+        full_scale = float(1 << (8 * audio.sample_width - 1))
+        return np.array(audio.get_array_of_samples(), dtype=np.float32).reshape(-1, self.channels) / full_scale
+
+    def _ms_to_samples(self, ms: int):
+        return int(ms * self.sample_rate / 1000)
+
+    def _load_stem(self, song_title: str, stem_type: str):
         filename = "vocals.wav" if stem_type == "vocals" else "no_vocals.wav"
         source_brief = self.briefs.get(song_title)
         if not source_brief:
@@ -34,53 +76,64 @@ class AudioEngine:
         return AudioSegment.from_file(stem_path)
 
     def _get_segment_milliseconds(self, song_title: str, segment_name: str):
-        brief = self.briefs[song_title]
-        segment_info = brief['analysis_results']['segments'].get(segment_name)
-        if not segment_info:
+        segment_ms = self._seg_ms.get((song_title, segment_name))
+        if not segment_ms:
             raise ValueError(f"Segment '{segment_name}' not found in brief for '{song_title}'")
-        start_ms = segment_info['start_time'] * 1000
-        end_ms = segment_info['end_time'] * 1000
-        return int(start_ms), int(end_ms)
+        return segment_ms
         
-    def _time_stretch_segment(self, audio_clip: AudioSegment, target_duration_ms: int):
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_in_file:
-            audio_clip.export(temp_in_file.name, format="wav")
-            temp_in_filename = temp_in_file.name
-        y, sr = sf.read(temp_in_filename)
-        current_duration_ms = len(audio_clip)
-        stretch_ratio = current_duration_ms / target_duration_ms
-        y_stretched = pyrb.time_stretch(y, sr, stretch_ratio)
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_out_file:
-             sf.write(temp_out_file.name, y_stretched, sr)
-             temp_out_filename = temp_out_file.name
-        stretched_segment = AudioSegment.from_file(temp_out_filename)
-        os.remove(temp_in_filename)
-        os.remove(temp_out_filename)
-        return stretched_segment
+    def _time_stretch_segment(self, audio_clip: np.ndarray, target_samples: int):
+        stretch_ratio = len(audio_clip) / target_samples
+        return pyrb.time_stretch(audio_clip, self.sample_rate, stretch_ratio).astype(np.float32)
+
+    def _pitch_shift_segment(self, audio_clip: np.ndarray, semitones: float):
+        # Varispeed shift: play the clip back faster or slower, so pitch and duration change together.
+        rate = 2 ** (semitones / 12.0)
+        positions = np.arange(int(len(audio_clip) / rate)) * rate
+        frames = np.arange(len(audio_clip))
+        return np.stack([np.interp(positions, frames, audio_clip[:, c]) for c in range(audio_clip.shape[1])], axis=1).astype(np.float32)
+
+    def _layout_timeline(self):
+        """Returns (start_sample, length, crossfade) for each timeline item, plus the total length."""
+        layout, end, prev_length = [], 0, 0
+        crossfade_samples = self._ms_to_samples(self.crossfade_ms)
+        for timeline_start_ms, timeline_end_ms in self._timeline_ms:
+            length = self._ms_to_samples(timeline_end_ms - timeline_start_ms)
+            # Half of each neighbour at most, so consecutive crossfades can never overlap on a short item.
+            crossfade = min(crossfade_samples, length // 2, prev_length // 2)
+            layout.append((end - crossfade, length, crossfade))
+            end += length - crossfade
+            prev_length = length
+        return layout, end
 
     def execute_recipe(self):
         print("Executing FINAL recipe with AudioEngine v2.1...")
-        final_mashup = AudioSegment.empty()
-        for item in self.recipe['timeline']:
-            timeline_start_ms, timeline_end_ms = [int(t) for t in item['time_ms'].split('-')]
-            timeline_duration_ms = timeline_end_ms - timeline_start_ms
-            segment_mix = AudioSegment.silent(duration=timeline_duration_ms)
+        layout, total_samples = self._layout_timeline()
+        final_mashup = np.zeros((total_samples, self.channels), dtype=np.float32)
+        for item, (start, length, crossfade) in zip(self.recipe['timeline'], layout):
+            segment_mix = np.zeros((length, self.channels), dtype=np.float32)
             for layer, details in item['layers'].items():
                 if not details: continue
                 source_audio = self._get_stem(details['source'], layer)
                 clip_start_ms, clip_end_ms = self._get_segment_milliseconds(details['source'], details['segment'])
-                audio_clip = source_audio[clip_start_ms:clip_end_ms]
-                if len(audio_clip) > 0 and abs(len(audio_clip) - timeline_duration_ms) > 10:
-                    audio_clip = self._time_stretch_segment(audio_clip, timeline_duration_ms)
-                if "pitch_shift_semitones" in details:
-                    semitones = details.get("pitch_shift_semitones", 0)
-                    if semitones != 0:
-                        audio_clip = audio_clip._spawn(audio_clip.raw_data, overrides={"frame_rate": int(audio_clip.frame_rate * (2 ** (semitones / 12.0)))}).set_frame_rate(audio_clip.frame_rate)
-                segment_mix = segment_mix.overlay(audio_clip)
-            final_mashup = final_mashup.append(segment_mix, crossfade=100)
-        final_mashup = normalize(final_mashup)
+                audio_clip = source_audio[self._ms_to_samples(clip_start_ms):self._ms_to_samples(clip_end_ms)]
+                if len(audio_clip) > 0 and abs(len(audio_clip) - length) > self._ms_to_samples(10):
+                    audio_clip = self._time_stretch_segment(audio_clip, length)
+                semitones = details.get("pitch_shift_semitones", 0)
+                if semitones != 0:
+                    audio_clip = self._pitch_shift_segment(audio_clip, semitones)
+                n = min(len(audio_clip), length)
+                segment_mix[:n] += audio_clip[:n]
+            if crossfade:
+                ramp = np.linspace(0.0, 1.0, crossfade, dtype=np.float32)[:, None]
+                final_mashup[start:start + crossfade] *= ramp[::-1]
+                segment_mix[:crossfade] *= ramp
+            final_mashup[start:start + length] += segment_mix
+        # Peak-normalize to -0.1 dBFS, matching pydub.effects.normalize's default headroom.
+        peak = np.max(np.abs(final_mashup)) if total_samples else 0.0
+        if peak > 0:
+            final_mashup *= (10 ** (-0.1 / 20)) / peak
         version = self.recipe.get('version', '2.1')
         output_filename = f"{self.recipe['mashup_title'].replace(' ', '_').replace('vs', '')}_v{version}.wav"
         output_path = os.path.join(self.output_dir, output_filename)
-        final_mashup.export(output_path, format="wav")
+        sf.write(output_path, final_mashup, self.sample_rate, subtype="PCM_16")
         return output_filename
@@ -1,12 +1,52 @@
 import os
+import copy
 import json
+import orjson
 from openai import OpenAI
 from anthropic import Anthropic
 
+EDIT_TIMELINE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "edits": {
+            "type": "array",
+            "description": "Edits to apply in order.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "action": {
+                        "type": "string",
+                        "enum": ["set_time_ms", "swap_layer_source", "shift_all_after", "set_pitch_shift"],
+                        "description": (
+                            "set_time_ms: set item_index to start_ms-end_ms. "
+                            "swap_layer_source: play segment of song source on layer of item_index. "
+                            "shift_all_after: move item_index and every later item by delta_ms. "
+                            "set_pitch_shift: transpose layer of item_index by semitones."
+                        )
+                    },
+                    "item_index": {"type": "integer"},
+                    "start_ms": {"type": "integer", "minimum": 0},
+                    "end_ms": {"type": "integer", "minimum": 0},
+                    "delta_ms": {"type": "integer"},
+                    "layer": {"type": "string", "enum": ["instrumental", "vocals"]},
+                    "source": {"type": "string"},
+                    "segment": {"type": "string"},
+                    "semitones": {"type": "number"}
+                },
+                "required": ["action", "item_index"]
+            }
+        }
+    },
+    "required": ["edits"]
+}
+
+EDIT_TIMELINE_DESCRIPTION = "Apply edits to the mashup timeline."
+
 class RevisionEngine:
     """
     Handles revising a mashup recipe by leveraging a Large Language Model (LLM)
-    to understand natural language commands and rewrite the JSON recipe.
+    to understand natural language commands and turn them into timeline edits,
+    which are applied to the recipe locally.
     """
 
     def __init__(self, current_recipe: dict, user_command: str):
@@ -23,29 +63,78 @@ class RevisionEngine:
                 "At least one of OPENAI_API_KEY or ANTHROPIC_API_KEY must be set."
             )
 
+    def _timeline_summary(self):
+        """The recipe as the LLM sees it: one line per timeline item plus the segments each song offers."""
+        return {
+            "timeline": [
+                {
+                    "index": i,
+                    "time_ms": item['time_ms'],
+                    "layers": {
+                        layer: {k: v for k, v in details.items() if k in ("source", "segment", "pitch_shift_semitones")}
+                        for layer, details in item['layers'].items() if details
+                    }
+                }
+                for i, item in enumerate(self.recipe['timeline'])
+            ],
+            "songs": {
+                b['song_info']['title']: {
+                    name: f"{int(info['start_time']*1000)}-{int(info['end_time']*1000)}"
+                    for name, info in b['analysis_results']['segments'].items()
+                }
+                for b in self.recipe.get('briefs', [])
+            }
+        }
+
     def _construct_prompt(self):
         system_prompt = """
-        You are a music production assistant AI. Your task is to modify a JSON "mashup recipe" based on a user's natural language command.
-        Your ONLY output must be the complete, modified JSON recipe. Do not add any conversational text, explanations, or code formatting like ```json.
+        You are a music production assistant AI. Your task is to edit a mashup timeline based on a user's natural language command.
+        Respond ONLY by calling the edit_timeline tool.
         Rules:
         1. Analyze the user's command to understand their intent.
-        2. Identify the target timeline item(s) to modify.
-        3. Modify the JSON structure directly to apply the change.
-        4. If changing timing, you must update the "time_ms" fields for the target item and all subsequent items.
-        5. Increment the "version" number by 1.
-        6. Ensure the final output is a single, valid JSON object.
+        2. Identify the target timeline item(s) by index.
+        3. Express the change as the smallest list of edits.
+        4. If changing an item's length, also shift all subsequent items so they stay back to back.
+        5. Only reference songs and segments listed under "songs".
         """
         user_prompt = f"""
-        Current mashup recipe:
-        {json.dumps(self.recipe, indent=2)}
+        Current mashup timeline:
+        {orjson.dumps(self._timeline_summary()).decode()}
 
         User's command:
         "{self.command}"
-
-        Provide the complete, updated JSON recipe.
         """
         return system_prompt, user_prompt
 
+    def _apply_edits(self, edits: list):
+        """Applies tool-call edits to a copy of the timeline and returns the new recipe."""
+        timeline = copy.deepcopy(self.recipe['timeline'])
+        segments = {b['song_info']['title']: b['analysis_results']['segments'] for b in self.recipe.get('briefs', [])}
+        for edit in edits:
+            action, index = edit['action'], edit['item_index']
+            if not 0 <= index < len(timeline):
+                raise ValueError(f"Timeline item {index} does not exist.")
+            item = timeline[index]
+            if action == "set_time_ms":
+                if edit['start_ms'] < 0 or edit['end_ms'] <= edit['start_ms']:
+                    raise ValueError(f"Invalid time range {edit['start_ms']}-{edit['end_ms']} for item {index}.")
+                item['time_ms'] = f"{edit['start_ms']}-{edit['end_ms']}"
+            elif action == "shift_all_after":
+                for later in timeline[index:]:
+                    start, end = [int(t) for t in later['time_ms'].split('-')]
+                    later['time_ms'] = f"{max(start + edit['delta_ms'], 0)}-{max(end + edit['delta_ms'], 0)}"
+            elif action == "swap_layer_source":
+                if edit['segment'] not in segments.get(edit['source'], {}):
+                    raise ValueError(f"Segment '{edit['segment']}' not found in brief for '{edit['source']}'")
+                item['layers'][edit['layer']] = {**(item['layers'].get(edit['layer']) or {}), "source": edit['source'], "segment": edit['segment']}
+            elif action == "set_pitch_shift":
+                if not item['layers'].get(edit['layer']):
+                    raise ValueError(f"Item {index} has no '{edit['layer']}' layer.")
+                item['layers'][edit['layer']]['pitch_shift_semitones'] = edit['semitones']
+            else:
+                raise ValueError(f"Unknown edit action '{action}'.")
+        return {**self.recipe, "timeline": timeline, "version": self.recipe.get('version', 1) + 1}
+
     def revise(self):
         print(f"Contacting AI Creative Assistant with command: '{self.command}'")
         system_prompt, user_prompt = self._construct_prompt()
@@ -59,11 +148,19 @@ class RevisionEngine:
                         {"role": "user", "content": user_prompt}
                     ],
                     temperature=0.2,
-                    response_format={"type": "json_object"}
+                    tools=[{
+                        "type": "function",
+                        "function": {"name": "edit_timeline", "description": EDIT_TIMELINE_DESCRIPTION, "parameters": EDIT_TIMELINE_SCHEMA}
+                    }],
+                    tool_choice={"type": "function", "function": {"name": "edit_timeline"}}
                 )
-                response_content = response.choices[0].message.content
-                new_recipe = json.loads(response_content)
-                print("Successfully received recipe from OpenAI.")
+                edits = [
+                    edit
+                    for call in response.choices[0].message.tool_calls
+                    for edit in json.loads(call.function.arguments)['edits']
+                ]
+                new_recipe = self._apply_edits(edits)
+                print(f"Applied {len(edits)} edit(s) from OpenAI.")
                 return new_recipe
             except Exception as e:
                 print(f"OpenAI failed: {e}")
@@ -75,11 +172,13 @@ class RevisionEngine:
                     model="claude-4-opus-20250514",
                     max_tokens=1024,
                     system=system_prompt,
-                    messages=[{"role": "user", "content": user_prompt}]
+                    messages=[{"role": "user", "content": user_prompt}],
+                    tools=[{"name": "edit_timeline", "description": EDIT_TIMELINE_DESCRIPTION, "input_schema": EDIT_TIMELINE_SCHEMA}],
+                    tool_choice={"type": "tool", "name": "edit_timeline"}
                 )
-                response_content = response.content[0].text
-                new_recipe = json.loads(response_content)
-                print("Successfully received recipe from Anthropic.")
+                edits = [edit for block in response.content if block.type == "tool_use" for edit in block.input['edits']]
+                new_recipe = self._apply_edits(edits)
+                print(f"Applied {len(edits)} edit(s) from Anthropic.")
                 return new_recipe
             except Exception as e:
                 print(f"Anthropic failed: {e}")
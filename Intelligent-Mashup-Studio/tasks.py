@@ -1,30 +1,57 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from analyzer import AudioAnalyzer
 from creator import MashupCreator
-from engine import AudioEngine
+from engine import AudioEngine, separate_stems
 from reviser import RevisionEngine
 
+# Demucs (htdemucs) needs several GB of RAM/VRAM per run, so separation is capped per worker process
+# and shared across jobs rather than sized to the request's song count.
+STEM_SEPARATION_WORKERS = int(os.environ.get("STEM_SEPARATION_WORKERS", "1"))
+stem_executor = ThreadPoolExecutor(max_workers=STEM_SEPARATION_WORKERS)
+
 def create_mashup_task(job_id, songs, jobs):
     """The main background task for creating a mashup from scratch."""
+    # Stem separation only needs the downloaded audio, so Demucs starts as each download lands
+    # and runs alongside analysis and recipe creation. It is a subprocess, so threads suffice.
+    stem_futures = []
     try:
         jobs[job_id]["status"] = "processing"
         
-        # 1. Download and Analyze all songs
-        creative_briefs = []
-        for i, song_query in enumerate(songs):
-            jobs[job_id]["progress"] = f"Analyzing song {i+1}/{len(songs)}: {song_query['query']}"
-            analyzer = AudioAnalyzer(song_query['query'])
-            brief = analyzer.full_analysis()
+        # 1. Download and Analyze all songs concurrently. yt-dlp runs as a subprocess and
+        # librosa's heavy kernels release the GIL, so threads are enough here.
+        # Identical queries are analyzed once, so two threads never download or cache the same song.
+        queries = list(dict.fromkeys(song_query['query'] for song_query in songs))
+        progress_lock = Lock()
+        analyzed = [0]
+        jobs[job_id]["progress"] = f"Analyzing {len(queries)} songs..."
+
+        def start_separation(audio_path):
+            stem_futures.append(stem_executor.submit(separate_stems, audio_path))
+
+        def analyze(query):
+            brief = AudioAnalyzer(query).full_analysis(on_audio_ready=start_separation)
             if not brief:
-                raise Exception(f"Analysis failed for {song_query['query']}")
-            creative_briefs.append(brief)
+                raise Exception(f"Analysis failed for {query}")
+            with progress_lock:
+                analyzed[0] += 1
+                jobs[job_id]["progress"] = f"Analyzed song {analyzed[0]}/{len(queries)}: {query}"
+            return brief
+
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            briefs_by_query = dict(zip(queries, executor.map(analyze, queries)))
+        creative_briefs = [briefs_by_query[song_query['query']] for song_query in songs]
 
         # 2. Create the Mashup Recipe
         jobs[job_id]["progress"] = "Generating creative recipe..."
         director = MashupCreator(creative_briefs)
         recipe = director.create_mashup_recipe()
         
-        # 3. Render the audio
+        # 3. Render the audio once every stem separation has finished
+        jobs[job_id]["progress"] = "Separating stems..."
+        for future in stem_futures:
+            future.result()
         jobs[job_id]["progress"] = "Rendering audio..."
         audio_engine = AudioEngine(recipe)
         output_filename = audio_engine.execute_recipe()